@@ -14,6 +14,7 @@ from pysim import util
 
 from common import AutoTest
 from common import NotAchievedException, AutoTestTimeoutException, PreconditionFailedException
+from common import MsgRcvTimeoutException
 
 # get location of scripts
 testdir = os.path.dirname(os.path.realpath(__file__))
@@ -261,8 +262,7 @@ class AutoTestCopter(AutoTest):
         self.set_rc(4, 1580)
         self.wait_heading(10)
         self.set_rc(4, 1500)
-        self.mav.recv_match(condition='RC_CHANNELS.chan4_raw==1500',
-                            blocking=True)
+        self.wait_rc_channel_value(4, 1500)
 
         # save bottom left corner of box as waypoint
         self.progress("Save WP 1 & 2")
@@ -275,45 +275,20 @@ class AutoTestCopter(AutoTest):
         # increase throttle a bit because we're about to pitch:
         self.set_rc(3, 1525)
 
-        # pitch forward to fly north
-        self.progress("Going north %u meters" % side)
-        self.set_rc(2, 1300)
-        self.wait_distance(side)
-        self.set_rc(2, 1500)
-
-        # save top left corner of square as waypoint
-        self.progress("Save WP 3")
-        self.save_wp()
-
-        # roll right to fly east
-        self.progress("Going east %u meters" % side)
-        self.set_rc(1, 1700)
-        self.wait_distance(side)
-        self.set_rc(1, 1500)
-
-        # save top right corner of square as waypoint
-        self.progress("Save WP 4")
-        self.save_wp()
-
-        # pitch back to fly south
-        self.progress("Going south %u meters" % side)
-        self.set_rc(2, 1700)
-        self.wait_distance(side)
-        self.set_rc(2, 1500)
-
-        # save bottom right corner of square as waypoint
-        self.progress("Save WP 5")
-        self.save_wp()
-
-        # roll left to fly west
-        self.progress("Going west %u meters" % side)
-        self.set_rc(1, 1300)
-        self.wait_distance(side)
-        self.set_rc(1, 1500)
-
-        # save bottom left corner of square (should be near home) as waypoint
-        self.progress("Save WP 6")
-        self.save_wp()
+        # fly the sides of the square by pitching and rolling, saving
+        # each corner as a waypoint; the last corner should be near home
+        square_legs = (("north", 2, 1300, 3),  # pitch forward
+                       ("east", 1, 1700, 4),   # roll right
+                       ("south", 2, 1700, 5),  # pitch back
+                       ("west", 1, 1300, 6))   # roll left
+        for (direction, chan, pwm, wp) in square_legs:
+            self.progress("Going %s %u meters" % (direction, side))
+            self.set_rc(chan, pwm)
+            self.wait_distance(side)
+            self.set_rc(chan, 1500)
+
+            self.progress("Save WP %u" % wp)
+            self.save_wp()
 
         # reduce throttle again
         self.set_rc(3, 1500)
@@ -1721,38 +1696,52 @@ class AutoTestCopter(AutoTest):
             self.user_takeoff(alt_min=10)
 
             startpos = self.mav.recv_match(type='GLOBAL_POSITION_INT',
-                                           blocking=True)
+                                           blocking=True,
+                                           timeout=10)
+            if startpos is None:
+                raise MsgRcvTimeoutException()
 
             """yaw through absolute angles using MAV_CMD_CONDITION_YAW"""
             self.guided_achieve_heading(45)
             self.guided_achieve_heading(135)
 
             """move the vehicle using set_position_target_global_int"""
+            # a position-control command; it is built once and resent:
+            target = self.mav.mav.set_position_target_global_int_encode(
+                0, # timestamp
+                1, # target system_id
+                1, # target component id
+                mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT,
+                0b1111111111111000, # mask specifying use-only-lat-lon-alt
+                5, # lat
+                5, # lon
+                10, # alt
+                0, # vx
+                0, # vy
+                0, # vz
+                0, # afx
+                0, # afy
+                0, # afz
+                0, # yaw
+                0, # yawrate
+            )
             tstart = self.get_sim_time()
+            last_send = None
             while True:
-                if self.get_sim_time() - tstart > 200:
+                now = self.get_sim_time_cached()
+                remaining = 200 - (now - tstart)
+                if remaining <= 0:
                     raise NotAchievedException()
-                # send a position-control command
-                self.mav.mav.set_position_target_global_int_send(
-                    0, # timestamp
-                    1, # target system_id
-                    1, # target component id
-                    mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT,
-                    0b1111111111111000, # mask specifying use-only-lat-lon-alt
-                    5, # lat
-                    5, # lon
-                    10, # alt
-                    0, # vx
-                    0, # vy
-                    0, # vz
-                    0, # afx
-                    0, # afy
-                    0, # afz
-                    0, # yaw
-                    0, # yawrate
-                )
+                # the target persists in the vehicle, so resend it once a
+                # second rather than for every position received:
+                if last_send is None or now - last_send >= 1:
+                    last_send = now
+                    self.mav.mav.send(target)
                 pos = self.mav.recv_match(type='GLOBAL_POSITION_INT',
-                                          blocking=True)
+                                          blocking=True,
+                                          timeout=remaining)
+                if pos is None:
+                    continue
                 delta = self.get_distance_int(startpos, pos)
                 self.progress("delta=%f (want >10)" % delta)
                 if delta > 10:
@@ -3,11 +3,15 @@ from __future__ import print_function
 import abc
 import math
 import os
+import re
+import select
 import shutil
 import sys
+import tempfile
 import time
 import pexpect
 import fnmatch
+from functools import partial
 
 from pymavlink import mavwp, mavutil
 from pysim import util, vehicleinfo
@@ -16,12 +20,70 @@ from pysim import util, vehicleinfo
 # messages. This keeps the output to stdout flowing
 expect_list = []
 
+# vehicle types flown as copters
+COPTER_TYPES = frozenset([mavutil.mavlink.MAV_TYPE_QUADROTOR,
+                          mavutil.mavlink.MAV_TYPE_HELICOPTER,
+                          mavutil.mavlink.MAV_TYPE_HEXAROTOR,
+                          mavutil.mavlink.MAV_TYPE_OCTOROTOR,
+                          mavutil.mavlink.MAV_TYPE_COAXIAL,
+                          mavutil.mavlink.MAV_TYPE_TRICOPTER])
+
+# EKF_STATUS_REPORT flags; all of these must be set for arming to happen:
+EKF_REQUIRED_FLAGS = (mavutil.mavlink.EKF_ATTITUDE |
+                      mavutil.mavlink.ESTIMATOR_VELOCITY_HORIZ |
+                      mavutil.mavlink.ESTIMATOR_VELOCITY_VERT |
+                      mavutil.mavlink.ESTIMATOR_POS_HORIZ_REL |
+                      mavutil.mavlink.ESTIMATOR_PRED_POS_HORIZ_REL)
+# none of these must be set for arming to happen:
+EKF_ERROR_FLAGS = (mavutil.mavlink.ESTIMATOR_CONST_POS_MODE |
+                   mavutil.mavlink.ESTIMATOR_ACCEL_ERROR)
+# ... and the same when an absolute position is required:
+EKF_REQUIRED_FLAGS_ABSOLUTE = (EKF_REQUIRED_FLAGS |
+                               mavutil.mavlink.ESTIMATOR_POS_HORIZ_ABS |
+                               mavutil.mavlink.ESTIMATOR_POS_VERT_ABS |
+                               mavutil.mavlink.ESTIMATOR_PRED_POS_HORIZ_ABS)
+EKF_ERROR_FLAGS_ABSOLUTE = (EKF_ERROR_FLAGS |
+                            mavutil.mavlink.ESTIMATOR_GPS_GLITCH)
+
+# ground distance per degree, and per 1e7-scaled degree as used in
+# *_INT messages; see get_distance and get_distance_int
+METRES_PER_DEGREE = 1.113195e5
+METRES_PER_DEGE7 = METRES_PER_DEGREE * 1.0e-7
+
+# waypoint counts of mission files, keyed on (filename, mtime)
+mission_count_cache = {}
+
 # get location of scripts
 testdir = os.path.dirname(os.path.realpath(__file__))
 
+# MAVProxy output patterns we wait on repeatedly.  pexpect compiles
+# string patterns on every expect() call, so hand it compiled ones:
+RE_PARAMS_LOADED = re.compile("Loaded ([0-9]+) parameters")
+RE_PARAMS_RECEIVED = re.compile("Received [0-9]+ parameters")
+RE_TILT_ALIGNMENT_COMPLETE = re.compile("tilt alignment complete")
+# MAVProxy's complaint when a parameter set is not acknowledged
+RE_PARAM_SET_FAILED = re.compile("(timeout setting|[Ff]ailed to set) ([A-Za-z0-9_]+)")
+
+# "lambda: self.some_test)" - a lambda returning a method rather than
+# calling it; see check_test_syntax
+RE_LAMBDA_WITHOUT_CALL = re.compile(r"lambda\s*:\s*\w+\.\w+\s*\)")
+
+# per-parameter "NAME = value" patterns, filled in by param_value_re
+param_value_re_cache = {}
+
+
+def param_value_re(name):
+    """Return compiled pattern matching MAVProxy's display of name."""
+    ret = param_value_re_cache.get(name)
+    if ret is None:
+        ret = re.compile("%s = ([-0-9.]*)\r\n" % re.escape(name))
+        param_value_re_cache[name] = ret
+    return ret
+
+
 # Check python version for abstract base class
-if sys.version_info[0] >= 3 and sys.version_info[1] >= 4:
-        ABC = abc.ABC
+if sys.version_info >= (3, 4):
+    ABC = abc.ABC
 else:
     ABC = abc.ABCMeta('ABC', (), {})
 
@@ -175,15 +237,15 @@ class AutoTest(ABC):
     def apply_defaultfile_parameters(self):
         """Apply parameter file."""
         # setup test parameters
-        vinfo = vehicleinfo.VehicleInfo()
         if self.params is None:
+            vinfo = vehicleinfo.VehicleInfo()
             frames = vinfo.options[self.vehicleinfo_key()]["frames"]
             self.params = frames[self.frame]["default_params_filename"]
         if not isinstance(self.params, list):
             self.params = [self.params]
         for x in self.params:
             self.mavproxy.send("param load %s\n" % os.path.join(testdir, x))
-            self.mavproxy.expect('Loaded [0-9]+ parameters')
+            self.mavproxy.expect(RE_PARAMS_LOADED)
         self.set_parameter('LOG_REPLAY', 1)
         self.set_parameter('LOG_DISARMED', 1)
         self.reboot_sitl()
@@ -191,26 +253,32 @@ class AutoTest(ABC):
 
     def fetch_parameters(self):
         self.mavproxy.send("param fetch\n")
-        self.mavproxy.expect("Received [0-9]+ parameters")
+        self.mavproxy.expect(RE_PARAMS_RECEIVED)
 
     def reboot_sitl(self):
         """Reboot SITL instance and wait it to reconnect."""
         self.mavproxy.send("reboot\n")
-        self.mavproxy.expect("tilt alignment complete")
+        self.mavproxy.expect(RE_TILT_ALIGNMENT_COMPLETE)
         # empty mav to avoid getting old timestamps:
         if self.mav is not None:
-            while self.mav.recv_match(blocking=False):
-                pass
-        # after reboot stream-rates may be zero.  Prompt MAVProxy to
-        # send a rate-change message by changing away from our normal
-        # stream rates and back again:
-        if self.mav is not None:
-            tstart = self.get_sim_time()
-        while True:
-
+            self.drain_mav_unparsed()
+        # after reboot stream-rates may be zero.
+        if self.mav is None:
+            # Prompt MAVProxy to send a rate-change message by
+            # changing away from our normal stream rates and back
+            # again:
             self.mavproxy.send("set streamrate %u\n" % (self.sitl_streamrate()*2))
-            if self.mav is None:
-                break
+            self.mavproxy.send("set streamrate %u\n" % self.sitl_streamrate())
+            self.progress("Reboot complete")
+            return
+        # ask the vehicle for our stream rates directly:
+        tstart = self.get_sim_time()
+        while True:
+            self.mav.mav.request_data_stream_send(self.mav.target_system,
+                                                  self.mav.target_component,
+                                                  mavutil.mavlink.MAV_DATA_STREAM_ALL,
+                                                  self.sitl_streamrate(),
+                                                  1) # start
 
             if self.get_sim_time() - tstart > 10:
                 raise AutoTestTimeoutException()
@@ -221,7 +289,10 @@ class AutoTest(ABC):
             if m is not None:
                 print("Received (%s)" % str(m))
                 break
-        self.mavproxy.send("set streamrate %u\n" % self.sitl_streamrate())
+        # the drain discarded the post-reboot heartbeats unparsed, so
+        # flightmode and armed state are still from before the reboot:
+        if self.mav.wait_heartbeat(timeout=10) is None:
+            raise AutoTestTimeoutException()
         self.progress("Reboot complete")
 
     def close(self):
@@ -238,9 +309,9 @@ class AutoTest(ABC):
                                                   model=self.frame)
         if os.path.exists(valgrind_log):
             os.chmod(valgrind_log, 0o644)
-            shutil.copy(valgrind_log,
-                        self.buildlogs_path("%s-valgrind.log" %
-                                            self.log_name))
+            shutil.copyfile(valgrind_log,
+                            self.buildlogs_path("%s-valgrind.log" %
+                                                self.log_name))
 
     def start_test(self, description):
         self.progress("#")
@@ -275,23 +346,42 @@ class AutoTest(ABC):
         global expect_list
         expect_list.extend(list_to_add)
 
-    def idle_hook(self, mav):
-        """Called when waiting for a mavlink message."""
+    def drain_expect_list(self, exclude=None):
+        """Drain those entries of the expect list with pending output."""
         global expect_list
-        for p in expect_list:
+        try:
+            (ready, _, _) = select.select(expect_list, [], [], 0)
+        except (select.error, ValueError, OSError):
+            # e.g. a closed pexpect object; drain doesn't mind
+            ready = expect_list
+        for p in ready:
+            if p is exclude:
+                continue
             util.pexpect_drain(p)
 
+    def idle_hook(self, mav):
+        """Called when waiting for a mavlink message."""
+        self.drain_expect_list()
+
     def message_hook(self, mav, msg):
         """Called as each mavlink msg is received."""
         self.idle_hook(mav)
 
     def expect_callback(self, e):
         """Called when waiting for a expect pattern."""
-        global expect_list
-        for p in expect_list:
-            if p == e:
-                continue
-            util.pexpect_drain(p)
+        self.drain_expect_list(exclude=e)
+
+    def drain_mav_unparsed(self):
+        """Discard pending mavlink bytes without parsing them."""
+        count = 0
+        while True:
+            this = self.mav.recv(1000000)
+            if len(this) == 0:
+                break
+            count += len(this)
+        # anything cached from before the drain is stale:
+        self.mav.messages.pop('SYSTEM_TIME', None)
+        self.progress("Drained %u bytes from mav" % count)
 
     def drain_mav(self):
         count = 0
@@ -303,9 +393,14 @@ class AutoTest(ABC):
     #################################################
     # SIM UTILITIES
     #################################################
-    def get_sim_time(self):
+    def get_sim_time(self, timeout=10):
         """Get SITL time."""
-        m = self.mav.recv_match(type='SYSTEM_TIME', blocking=True)
+        m = self.mav.recv_match(type='SYSTEM_TIME',
+                                blocking=True,
+                                timeout=timeout)
+        if m is None:
+            self.progress("No SYSTEM_TIME received")
+            raise MsgRcvTimeoutException()
         return m.time_boot_ms * 1.0e-3
 
     def get_sim_time_cached(self):
@@ -326,16 +421,13 @@ class AutoTest(ABC):
     def save_wp(self):
         """Trigger RC 7 to save waypoint."""
         self.mavproxy.send('rc 7 1000\n')
-        self.mav.recv_match(condition='RC_CHANNELS.chan7_raw==1000',
-                            blocking=True)
+        self.wait_rc_channel_value(7, 1000)
         self.wait_seconds(1)
         self.mavproxy.send('rc 7 2000\n')
-        self.mav.recv_match(condition='RC_CHANNELS.chan7_raw==2000',
-                            blocking=True)
+        self.wait_rc_channel_value(7, 2000)
         self.wait_seconds(1)
         self.mavproxy.send('rc 7 1000\n')
-        self.mav.recv_match(condition='RC_CHANNELS.chan7_raw==1000',
-                            blocking=True)
+        self.wait_rc_channel_value(7, 1000)
         self.wait_seconds(1)
 
     def clear_wp(self):
@@ -354,13 +446,20 @@ class AutoTest(ABC):
         self.mav.wait_heartbeat()
         self.mavproxy.send("log list\n")
         self.mavproxy.expect("numLogs")
-        self.mav.wait_heartbeat()
-        self.mav.wait_heartbeat()
+        # wait for the rest of the log list rather than for heartbeats:
+        m = self.mav.recv_match(type='LOG_ENTRY',
+                                condition='LOG_ENTRY.id==LOG_ENTRY.last_log_num',
+                                blocking=True,
+                                timeout=5)
+        if m is None:
+            self.progress("Did not receive the end of the log list")
+            raise MsgRcvTimeoutException()
         self.mavproxy.send("set shownoise 0\n")
         self.mavproxy.send("log download latest %s\n" % filename)
         self.mavproxy.expect("Finished downloading", timeout=timeout)
-        self.mav.wait_heartbeat()
-        self.mav.wait_heartbeat()
+        if self.mav.wait_heartbeat(timeout=2) is None:
+            self.progress("No heartbeat after log download")
+            raise MsgRcvTimeoutException()
 
     def show_gps_and_sim_positions(self, on_off):
         """Allow to display gps and actual position on map."""
@@ -376,9 +475,13 @@ class AutoTest(ABC):
     @staticmethod
     def mission_count(filename):
         """Load a mission from a file and return number of waypoints."""
-        wploader = mavwp.MAVWPLoader()
-        wploader.load(filename)
-        num_wp = wploader.count()
+        key = (filename, os.path.getmtime(filename))
+        num_wp = mission_count_cache.get(key)
+        if num_wp is None:
+            wploader = mavwp.MAVWPLoader()
+            wploader.load(filename)
+            num_wp = wploader.count()
+            mission_count_cache[key] = num_wp
         return num_wp
 
     def load_mission_from_file(self, filename):
@@ -389,10 +492,7 @@ class AutoTest(ABC):
         self.mavproxy.expect('Requesting [0-9]+ waypoints')
 
         # update num_wp
-        wploader = mavwp.MAVWPLoader()
-        wploader.load(filename)
-        num_wp = wploader.count()
-        return num_wp
+        return self.mission_count(filename)
 
     def save_mission_to_file(self, filename):
         """Save a mission to a file"""
@@ -406,18 +506,20 @@ class AutoTest(ABC):
 
     def set_rc_default(self):
         """Setup all simulated RC control to 1500."""
-        for chan in range(1, 16):
-            self.mavproxy.send('rc %u 1500\n' % chan)
+        self.mavproxy.send('rc all 1500\n')
 
     def set_rc(self, chan, pwm, timeout=2000):
         """Setup a simulated RC control to a PWM value"""
         self.drain_mav()
+        channel_field = "chan%u_raw" % chan
         tstart = self.get_sim_time()
         wclock = time.time()
         while self.get_sim_time_cached() < tstart + timeout:
             self.mavproxy.send('rc %u %u\n' % (chan, pwm))
-            m = self.mav.recv_match(type='RC_CHANNELS', blocking=True)
-            chan_pwm = getattr(m, "chan" + str(chan) + "_raw")
+            m = self.mav.recv_match(type='RC_CHANNELS', blocking=True, timeout=1)
+            if m is None:
+                continue
+            chan_pwm = getattr(m, channel_field)
             wclock_delta = time.time() - wclock
             sim_time_delta = self.get_sim_time_cached()-tstart
             if sim_time_delta == 0:
@@ -471,12 +573,7 @@ class AutoTest(ABC):
         self.set_rc(chan, out_trim)
 
     def get_rudder_channel(self):
-        if self.mav.mav_type in [mavutil.mavlink.MAV_TYPE_QUADROTOR,
-                                 mavutil.mavlink.MAV_TYPE_HELICOPTER,
-                                 mavutil.mavlink.MAV_TYPE_HEXAROTOR,
-                                 mavutil.mavlink.MAV_TYPE_OCTOROTOR,
-                                 mavutil.mavlink.MAV_TYPE_COAXIAL,
-                                 mavutil.mavlink.MAV_TYPE_TRICOPTER]:
+        if self.mav.mav_type in COPTER_TYPES:
             return int(self.get_parameter("RCMAP_YAW"))
         if self.mav.mav_type == mavutil.mavlink.MAV_TYPE_FIXED_WING:
             return int(self.get_parameter("RCMAP_YAW"))
@@ -552,8 +649,11 @@ class AutoTest(ABC):
         self.progress("Arm motors with radio")
         self.set_output_to_max(self.get_rudder_channel())
         tstart = self.get_sim_time()
-        while self.get_sim_time() < tstart + timeout:
-            self.mav.wait_heartbeat()
+        while True:
+            remaining = timeout - (self.get_sim_time_cached() - tstart)
+            if remaining <= 0:
+                break
+            self.mav.wait_heartbeat(timeout=remaining)
             if self.mav.motors_armed():
                 arm_delay = self.get_sim_time() - tstart
                 self.progress("MOTORS ARMED OK WITH RADIO")
@@ -569,8 +669,11 @@ class AutoTest(ABC):
         self.progress("Disarm motors with radio")
         self.set_output_to_min(self.get_rudder_channel())
         tstart = self.get_sim_time()
-        while self.get_sim_time() < tstart + timeout:
-            self.mav.wait_heartbeat()
+        while True:
+            remaining = timeout - (self.get_sim_time_cached() - tstart)
+            if remaining <= 0:
+                break
+            self.mav.wait_heartbeat(timeout=remaining)
             if not self.mav.motors_armed():
                 disarm_delay = self.get_sim_time() - tstart
                 self.progress("MOTORS DISARMED OK WITH RADIO")
@@ -615,8 +718,11 @@ class AutoTest(ABC):
             return True
         tstart = self.get_sim_time()
         timeout = 15
-        while self.get_sim_time() < tstart + timeout:
-            self.mav.wait_heartbeat()
+        while True:
+            remaining = timeout - (self.get_sim_time_cached() - tstart)
+            if remaining <= 0:
+                break
+            self.mav.wait_heartbeat(timeout=remaining)
             if not self.mav.motors_armed():
                 disarm_delay = self.get_sim_time() - tstart
                 self.progress("MOTORS AUTODISARMED")
@@ -644,8 +750,23 @@ class AutoTest(ABC):
         """Set parameters from vehicle."""
         old_value = self.get_parameter(name, retry=2)
         for i in range(1, 10):
-            self.mavproxy.send("param set %s %s\n" % (name, str(value)))
-            returned_value = self.get_parameter(name)
+            if self.mav is None:
+                self.mavproxy.send("param set %s %s\n" % (name, str(value)))
+                returned_value = self.get_parameter(name)
+            else:
+                # the vehicle echoes a PARAM_VALUE for every PARAM_SET;
+                # check that rather than requesting another one, which
+                # would leave its reply queued behind the echo:
+                self.mav.param_set_send(name.upper(), float(value))
+                m = self.mav.recv_match(type='PARAM_VALUE',
+                                        condition="PARAM_VALUE.param_id=='%s'" % name.upper(),
+                                        blocking=True,
+                                        timeout=10)
+                if m is None:
+                    continue
+                returned_value = m.param_value
+            if returned_value is None:
+                continue
             delta = float(value) - returned_value
             if abs(delta) < epsilon:
                 # yes, exactly equal.
@@ -660,10 +781,28 @@ class AutoTest(ABC):
 
     def get_parameter(self, name, retry=1, timeout=60):
         """Get parameters from vehicle."""
+        if self.mav is None:
+            return self.mavproxy_get_parameter(name,
+                                               retry=retry,
+                                               timeout=timeout)
+        name = name.upper()
+        for i in range(0, retry):
+            self.mav.param_fetch_one(name)
+            m = self.mav.recv_match(type='PARAM_VALUE',
+                                    condition="PARAM_VALUE.param_id=='%s'" % name,
+                                    blocking=True,
+                                    timeout=timeout/retry)
+            if m is not None:
+                return m.param_value
+        self.progress("No PARAM_VALUE received for %s" % name)
+        raise NotAchievedException()
+
+    def mavproxy_get_parameter(self, name, retry=1, timeout=60):
+        """Get parameters from vehicle via MAVProxy."""
         for i in range(0, retry):
             self.mavproxy.send("param fetch %s\n" % name)
             try:
-                self.mavproxy.expect("%s = ([-0-9.]*)\r\n" % (name,), timeout=timeout/retry)
+                self.mavproxy.expect(param_value_re(name), timeout=timeout/retry)
                 return float(self.mavproxy.match.group(1))
             except pexpect.TIMEOUT:
                 if i < retry:
@@ -681,14 +820,61 @@ class AutoTest(ABC):
         """Set parameters to origin values in reverse order."""
         dead = self.contexts.pop()
 
-        dead_parameters = dead.parameters
-        dead_parameters.reverse()
-        for p in dead_parameters:
+        # the first entry for a name holds its original value; keep
+        # that one, and restore in reverse order so that e.g. *_ENABLE
+        # is set after the parameters it gates:
+        restore = []
+        seen = set()
+        for (name, old_value) in dead.parameters:
+            if name in seen:
+                continue
+            seen.add(name)
+            restore.append((name, old_value))
+        restore.reverse()
+        if len(restore) == 0:
+            return
+        if self.load_parameters(restore):
+            return
+        self.progress("Bulk parameter restore failed; setting individually")
+        for p in restore:
             (name, old_value) = p
             self.set_parameter(name,
                                old_value,
                                add_to_context=False)
 
+    def load_parameters(self, parameters):
+        """Set a list of (name, value) pairs, in order, with a single
+        MAVProxy param load.  Returns False if any of them did not take."""
+        parm_file = tempfile.NamedTemporaryFile(mode='w',
+                                                suffix='.parm',
+                                                delete=False)
+        try:
+            for (name, value) in parameters:
+                parm_file.write("%s %s\n" % (name, str(value)))
+            parm_file.close()
+            self.mavproxy.send("param load %s\n" % parm_file.name)
+            self.mavproxy.expect(RE_PARAMS_LOADED)
+            loaded = int(self.mavproxy.match.group(1))
+            failed = RE_PARAM_SET_FAILED.findall(self.mavproxy.before)
+        finally:
+            os.unlink(parm_file.name)
+        if loaded != len(parameters):
+            self.progress("Loaded %u of %u parameters" %
+                          (loaded, len(parameters)))
+            return False
+        # MAVProxy counts a parameter as loaded even if setting it timed
+        # out, so also look for its complaints:
+        if failed:
+            self.progress("Failed to set %s" %
+                          ", ".join([name for (_, name) in failed]))
+            return False
+        for (name, value) in parameters:
+            if (self.should_fetch_all_for_parameter_change(name.upper()) and
+                    value != 0):
+                self.fetch_parameters()
+                break
+        return True
+
     def run_cmd(self,
                 command,
                 p1,
@@ -698,8 +884,10 @@ class AutoTest(ABC):
                 p5,
                 p6,
                 p7,
-                want_result=mavutil.mavlink.MAV_RESULT_ACCEPTED):
+                want_result=mavutil.mavlink.MAV_RESULT_ACCEPTED,
+                timeout=10):
         """Send a MAVLink command long."""
+        tstart = self.get_sim_time_cached()
         self.mav.mav.command_long_send(1,
                                        1,
                                        command,
@@ -712,12 +900,19 @@ class AutoTest(ABC):
                                        p6,
                                        p7)
         while True:
-            m = self.mav.recv_match(type='COMMAND_ACK', blocking=True)
-            self.progress("ACK received: %s" % str(m))
-            if m.command == command:
-                if m.result != want_result:
-                    raise ValueError()
+            remaining = timeout - (self.get_sim_time_cached() - tstart)
+            if remaining <= 0:
+                self.progress("No ACK received for command %u" % command)
+                raise MsgRcvTimeoutException()
+            m = self.mav.recv_match(type='COMMAND_ACK',
+                                    condition='COMMAND_ACK.command==%u' % command,
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is not None:
                 break
+        self.progress("ACK received: %s" % str(m))
+        if m.result != want_result:
+            raise ValueError()
 
     #################################################
     # UTILITIES
@@ -731,7 +926,7 @@ class AutoTest(ABC):
         except AttributeError:
             dlong = loc2.lon - loc1.lon
 
-        return math.sqrt((dlat*dlat) + (dlong*dlong)) * 1.113195e5
+        return math.hypot(dlat, dlong) * METRES_PER_DEGREE
 
     @staticmethod
     def get_distance_int(loc1, loc2):
@@ -743,20 +938,14 @@ class AutoTest(ABC):
         except AttributeError:
             dlong = loc2.lon - loc1.lon
 
-        dlat /= 10000000.0
-        dlong /= 10000000.0
-
-        return math.sqrt((dlat*dlat) + (dlong*dlong)) * 1.113195e5
+        return math.hypot(dlat, dlong) * METRES_PER_DEGE7
 
     @staticmethod
     def get_bearing(loc1, loc2):
         """Get bearing from loc1 to loc2."""
         off_x = loc2.lng - loc1.lng
         off_y = loc2.lat - loc1.lat
-        bearing = 90.00 + math.atan2(-off_y, off_x) * 57.2957795
-        if bearing < 0:
-            bearing += 360.00
-        return bearing
+        return (90.00 + math.degrees(math.atan2(-off_y, off_x))) % 360.00
 
     def do_get_autopilot_capabilities(self):
         tstart = self.get_sim_time()
@@ -842,17 +1031,11 @@ class AutoTest(ABC):
 
     def reach_heading_manual(self, heading):
         """Manually direct the vehicle to the target heading."""
-        if self.mav.mav_type in [mavutil.mavlink.MAV_TYPE_QUADROTOR,
-                                 mavutil.mavlink.MAV_TYPE_HELICOPTER,
-                                 mavutil.mavlink.MAV_TYPE_HEXAROTOR,
-                                 mavutil.mavlink.MAV_TYPE_OCTOROTOR,
-                                 mavutil.mavlink.MAV_TYPE_COAXIAL,
-                                 mavutil.mavlink.MAV_TYPE_TRICOPTER]:
+        if self.mav.mav_type in COPTER_TYPES:
             self.mavproxy.send('rc 4 1580\n')
             self.wait_heading(heading)
             self.mavproxy.send('rc 4 1500\n')
-            self.mav.recv_match(condition='RC_CHANNELS.chan4_raw==1500',
-                                blocking=True)
+            self.wait_rc_channel_value(4, 1500)
         if self.mav.mav_type == mavutil.mavlink.MAV_TYPE_FIXED_WING:
             self.progress("NOT IMPLEMENTED")
         if self.mav.mav_type == mavutil.mavlink.MAV_TYPE_GROUND_ROVER:
@@ -860,33 +1043,24 @@ class AutoTest(ABC):
             self.mavproxy.send('rc 3 1550\n')
             self.wait_heading(heading)
             self.mavproxy.send('rc 3 1500\n')
-            self.mav.recv_match(condition='RC_CHANNELS.chan3_raw==1500',
-                                blocking=True)
+            self.wait_rc_channel_value(3, 1500)
             self.mavproxy.send('rc 1 1500\n')
-            self.mav.recv_match(condition='RC_CHANNELS.chan1_raw==1500',
-                                blocking=True)
+            self.wait_rc_channel_value(1, 1500)
 
     def reach_distance_manual(self, distance):
         """Manually direct the vehicle to the target distance from home."""
-        if self.mav.mav_type in [mavutil.mavlink.MAV_TYPE_QUADROTOR,
-                                 mavutil.mavlink.MAV_TYPE_HELICOPTER,
-                                 mavutil.mavlink.MAV_TYPE_HEXAROTOR,
-                                 mavutil.mavlink.MAV_TYPE_OCTOROTOR,
-                                 mavutil.mavlink.MAV_TYPE_COAXIAL,
-                                 mavutil.mavlink.MAV_TYPE_TRICOPTER]:
+        if self.mav.mav_type in COPTER_TYPES:
             self.mavproxy.send('rc 2 1350\n')
             self.wait_distance(distance, accuracy=5, timeout=60)
             self.mavproxy.send('rc 2 1500\n')
-            self.mav.recv_match(condition='RC_CHANNELS.chan2_raw==1500',
-                                blocking=True)
+            self.wait_rc_channel_value(2, 1500)
         if self.mav.mav_type == mavutil.mavlink.MAV_TYPE_FIXED_WING:
             self.progress("NOT IMPLEMENTED")
         if self.mav.mav_type == mavutil.mavlink.MAV_TYPE_GROUND_ROVER:
             self.mavproxy.send('rc 3 1700\n')
             self.wait_distance(distance, accuracy=2)
             self.mavproxy.send('rc 3 1500\n')
-            self.mav.recv_match(condition='RC_CHANNELS.chan3_raw==1500',
-                                blocking=True)
+            self.wait_rc_channel_value(3, 1500)
 
     def guided_achieve_heading(self, heading):
         tstart = self.get_sim_time()
@@ -900,9 +1074,14 @@ class AutoTest(ABC):
                      0,  # p7
                      )
         while True:
-            if self.get_sim_time() - tstart > 200:
+            remaining = 200 - (self.get_sim_time_cached() - tstart)
+            if remaining <= 0:
                 raise NotAchievedException()
-            m = self.mav.recv_match(type='VFR_HUD', blocking=True)
+            m = self.mav.recv_match(type='VFR_HUD',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
             self.progress("heading=%f want=%f" % (m.heading, heading))
             if m.heading == heading:
                 return
@@ -913,9 +1092,23 @@ class AutoTest(ABC):
     def wait_seconds(self, seconds_to_wait):
         """Wait some second in SITL time."""
         tstart = self.get_sim_time()
-        tnow = tstart
-        while tstart + seconds_to_wait > tnow:
-            tnow = self.get_sim_time()
+        # let pymavlink do the waiting; we only get control back once
+        # SITL time has passed the target, or every few seconds to
+        # check the link has not stalled:
+        last_ms = self.mav.messages['SYSTEM_TIME'].time_boot_ms
+        deadline_ms = int((tstart + seconds_to_wait) * 1000)
+        while True:
+            m = self.mav.recv_match(type='SYSTEM_TIME',
+                                    condition='SYSTEM_TIME.time_boot_ms>=%u' % deadline_ms,
+                                    blocking=True,
+                                    timeout=5)
+            if m is not None:
+                return
+            # pymavlink caches the SYSTEM_TIMEs the condition skipped:
+            now_ms = self.mav.messages['SYSTEM_TIME'].time_boot_ms
+            if now_ms == last_ms:
+                raise MsgRcvTimeoutException()
+            last_ms = now_ms
 
     def wait_altitude(self, alt_min, alt_max, timeout=30, relative=False):
         """Wait for a given altitude range."""
@@ -925,8 +1118,14 @@ class AutoTest(ABC):
         self.progress("Waiting for altitude between %u and %u" %
                       (alt_min, alt_max))
         last_wait_alt_msg = 0
-        while self.get_sim_time_cached() < tstart + timeout:
-            m = self.mav.recv_match(type='GLOBAL_POSITION_INT', blocking=True)
+        while True:
+            now = self.get_sim_time_cached()
+            remaining = timeout - (now - tstart)
+            if remaining <= 0:
+                break
+            m = self.mav.recv_match(type='GLOBAL_POSITION_INT',
+                                    blocking=True,
+                                    timeout=remaining)
             if m is None:
                 continue
             if relative:
@@ -936,10 +1135,10 @@ class AutoTest(ABC):
 
             climb_rate = alt - previous_alt
             previous_alt = alt
-            if self.get_sim_time_cached() - last_wait_alt_msg > 1:
+            if now - last_wait_alt_msg > 1:
                 self.progress("Wait Altitude: Cur:%u, min_alt:%u, climb_rate: %u"
                               % (alt, alt_min, climb_rate))
-                last_wait_alt_msg = self.get_sim_time_cached()
+                last_wait_alt_msg = now
             if alt >= alt_min and alt <= alt_max:
                 self.progress("Altitude OK")
                 return True
@@ -952,12 +1151,20 @@ class AutoTest(ABC):
                       (gs_min, gs_max))
         last_print = 0
         tstart = self.get_sim_time()
-        while self.get_sim_time_cached() < tstart + timeout:
-            m = self.mav.recv_match(type='VFR_HUD', blocking=True)
-            if self.get_sim_time_cached() - last_print > 1:
+        while True:
+            now = self.get_sim_time_cached()
+            remaining = timeout - (now - tstart)
+            if remaining <= 0:
+                break
+            m = self.mav.recv_match(type='VFR_HUD',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
+            if now - last_print > 1:
                 self.progress("Wait groundspeed %.1f, target:%.1f" %
                               (m.groundspeed, gs_min))
-                last_print = self.get_sim_time_cached();
+                last_print = now
             if m.groundspeed >= gs_min and m.groundspeed <= gs_max:
                 return True
         self.progress("Failed to attain groundspeed range")
@@ -967,12 +1174,23 @@ class AutoTest(ABC):
         """Wait for a given roll in degrees."""
         tstart = self.get_sim_time()
         self.progress("Waiting for roll of %d at %s" % (roll, time.ctime()))
-        while self.get_sim_time() < tstart + timeout:
-            m = self.mav.recv_match(type='ATTITUDE', blocking=True)
+        last_print = 0
+        while True:
+            now = self.get_sim_time_cached()
+            remaining = timeout - (now - tstart)
+            if remaining <= 0:
+                break
+            m = self.mav.recv_match(type='ATTITUDE',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
             p = math.degrees(m.pitch)
             r = math.degrees(m.roll)
-            self.progress("Roll %d Pitch %d" % (r, p))
-            if math.fabs(r - roll) <= accuracy:
+            if now - last_print > 1:
+                self.progress("Roll %d Pitch %d" % (r, p))
+                last_print = now
+            if abs(r - roll) <= accuracy:
                 self.progress("Attained roll %d" % roll)
                 return True
         self.progress("Failed to attain roll %d" % roll)
@@ -982,12 +1200,23 @@ class AutoTest(ABC):
         """Wait for a given pitch in degrees."""
         tstart = self.get_sim_time()
         self.progress("Waiting for pitch of %u at %s" % (pitch, time.ctime()))
-        while self.get_sim_time() < tstart + timeout:
-            m = self.mav.recv_match(type='ATTITUDE', blocking=True)
+        last_print = 0
+        while True:
+            now = self.get_sim_time_cached()
+            remaining = timeout - (now - tstart)
+            if remaining <= 0:
+                break
+            m = self.mav.recv_match(type='ATTITUDE',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
             p = math.degrees(m.pitch)
             r = math.degrees(m.roll)
-            self.progress("Pitch %d Roll %d" % (p, r))
-            if math.fabs(p - pitch) <= accuracy:
+            if now - last_print > 1:
+                self.progress("Pitch %d Roll %d" % (p, r))
+                last_print = now
+            if abs(p - pitch) <= accuracy:
                 self.progress("Attained pitch %d" % pitch)
                 return True
         self.progress("Failed to attain pitch %d" % pitch)
@@ -1001,14 +1230,19 @@ class AutoTest(ABC):
         last_print_time = 0
         while True:
             now = self.get_sim_time_cached()
-            if now - tstart >= timeout:
+            remaining = timeout - (now - tstart)
+            if remaining <= 0:
                 break
-            m = self.mav.recv_match(type='VFR_HUD', blocking=True)
+            m = self.mav.recv_match(type='VFR_HUD',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
             if now - last_print_time > 1:
                 self.progress("Heading %u (want %f +- %f)" % (
                         m.heading, heading, accuracy))
                 last_print_time = now
-            if math.fabs(m.heading - heading) <= accuracy:
+            if abs(m.heading - heading) <= accuracy:
                 self.progress("Attained heading %u" % heading)
                 return True
         self.progress("Failed to attain heading %u" % heading)
@@ -1017,16 +1251,28 @@ class AutoTest(ABC):
     def wait_distance(self, distance, accuracy=5, timeout=30):
         """Wait for flight of a given distance."""
         tstart = self.get_sim_time()
-        start = self.mav.location()
+        start = self.mav.recv_match(type='GLOBAL_POSITION_INT',
+                                    blocking=True,
+                                    timeout=timeout)
+        if start is None:
+            raise MsgRcvTimeoutException()
         last_distance_message = 0
-        while self.get_sim_time() < tstart + timeout:
-            pos = self.mav.location()
-            delta = self.get_distance(start, pos)
-            if self.get_sim_time_cached() - last_distance_message >= 1:
+        while True:
+            now = self.get_sim_time_cached()
+            remaining = timeout - (now - tstart)
+            if remaining <= 0:
+                break
+            m = self.mav.recv_match(type='GLOBAL_POSITION_INT',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
+            delta = self.get_distance_int(start, m)
+            if now - last_distance_message >= 1:
                 self.progress("Distance=%.2f meters want=%.2f" %
                               (delta, distance))
-                last_distance_message = self.get_sim_time_cached()
-            if math.fabs(delta - distance) <= accuracy:
+                last_distance_message = now
+            if abs(delta - distance) <= accuracy:
                 self.progress("Attained distance %.2f meters OK" % delta)
                 return True
             if delta > (distance + accuracy):
@@ -1047,6 +1293,8 @@ class AutoTest(ABC):
             m = self.mav.recv_match(type='SERVO_OUTPUT_RAW',
                                     blocking=True,
                                     timeout=remaining)
+            if m is None:
+                continue
             m_value = getattr(m, channel_field, None)
             self.progress("SERVO_OUTPUT_RAW.%s=%u want=%u" %
                           (channel_field, m_value, value))
@@ -1055,6 +1303,24 @@ class AutoTest(ABC):
             if m_value == value:
                 return
 
+    def wait_rc_channel_value(self, channel, value, timeout=10):
+        """wait for RC_CHANNELS to report channel at value"""
+        channel_field = "chan%u_raw" % channel
+        tstart = self.get_sim_time()
+        while True:
+            remaining = timeout - (self.get_sim_time_cached() - tstart)
+            if remaining <= 0:
+                self.progress("RC_CHANNELS.%s never reached %u" %
+                              (channel_field, value))
+                raise NotAchievedException()
+            m = self.mav.recv_match(type='RC_CHANNELS',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
+            if getattr(m, channel_field) == value:
+                return
+
     def wait_location(self,
                       loc,
                       accuracy=5,
@@ -1068,15 +1334,29 @@ class AutoTest(ABC):
         self.progress("Waiting for location"
                       "%.4f,%.4f at altitude %.1f height_accuracy=%.1f" %
                       (loc.lat, loc.lng, target_altitude, height_accuracy))
+        # compare positions in GLOBAL_POSITION_INT's degE7 units rather than
+        # converting every message into a location:
+        target_lat = loc.lat * 1.0e7
+        target_lng = loc.lng * 1.0e7
         last_distance_message = 0
-        while self.get_sim_time() < tstart + timeout:
-            pos = self.mav.location()
-            delta = self.get_distance(loc, pos)
-            if self.get_sim_time_cached() - last_distance_message >= 1:
-                self.progress("Distance %.2f meters alt %.1f" % (delta, pos.alt))
-                last_distance_message = self.get_sim_time_cached()
+        while True:
+            now = self.get_sim_time_cached()
+            remaining = timeout - (now - tstart)
+            if remaining <= 0:
+                break
+            m = self.mav.recv_match(type='GLOBAL_POSITION_INT',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
+            delta = math.hypot(m.lat - target_lat,
+                               m.lon - target_lng) * METRES_PER_DEGE7
+            alt = m.alt * 1.0e-3
+            if now - last_distance_message >= 1:
+                self.progress("Distance %.2f meters alt %.1f" % (delta, alt))
+                last_distance_message = now
             if delta <= accuracy:
-                height_delta = math.fabs(pos.alt - target_altitude)
+                height_delta = abs(alt - target_altitude)
                 if height_accuracy != -1 and height_delta > height_accuracy:
                     continue
                 self.progress("Reached location (%.2f meters)" % delta)
@@ -1105,26 +1385,48 @@ class AutoTest(ABC):
         #    raise WaitWaypointTimeout()
 
         last_wp_msg = 0
-        while self.get_sim_time_cached() < tstart + timeout:
-            seq = self.mav.waypoint_current()
-            m = self.mav.recv_match(type='NAV_CONTROLLER_OUTPUT',
-                                    blocking=True)
-            wp_dist = m.wp_dist
-            m = self.mav.recv_match(type='VFR_HUD', blocking=True)
+        seq = start_wp
+        wp_dist = None
+        alt = None
+        while True:
+            now = self.get_sim_time_cached()
+            if now - tstart >= timeout:
+                break
+            # take whichever of these arrives next rather than
+            # blocking for each in turn:
+            m = self.mav.recv_match(type=['MISSION_CURRENT',
+                                          'NAV_CONTROLLER_OUTPUT',
+                                          'VFR_HUD'],
+                                    blocking=True,
+                                    timeout=1)
+            if m is None:
+                continue
+            t = m.get_type()
+            if t == 'MISSION_CURRENT':
+                if m.seq != seq:
+                    # wp_dist so far was to the previous waypoint
+                    wp_dist = None
+                seq = m.seq
+            elif t == 'NAV_CONTROLLER_OUTPUT':
+                wp_dist = m.wp_dist
+            else:
+                alt = m.alt
+            if wp_dist is None or alt is None:
+                continue
 
             # if we changed mode, fail
             if self.mav.flightmode != mode:
                 self.progress('Exited %s mode' % mode)
                 raise WaitWaypointTimeout()
 
-            if self.get_sim_time_cached() - last_wp_msg > 1:
+            if now - last_wp_msg > 1:
                 self.progress("WP %u (wp_dist=%u Alt=%d), current_wp: %u,"
                               "wpnum_end: %u" %
-                              (seq, wp_dist, m.alt, current_wp, wpnum_end))
-                last_wp_msg = self.get_sim_time_cached()
+                              (seq, wp_dist, alt, current_wp, wpnum_end))
+                last_wp_msg = now
             if seq == current_wp+1 or (seq > current_wp+1 and allow_skip):
                 self.progress("test: Starting new waypoint %u" % seq)
-                tstart = self.get_sim_time()
+                tstart = now
                 current_wp = seq
                 # the wp_dist check is a hack until we can sort out
                 # the right seqnum for end of mission
@@ -1149,12 +1451,18 @@ class AutoTest(ABC):
         self.get_mode_from_mode_mapping(mode)
         self.progress("Waiting for mode %s" % mode)
         tstart = self.get_sim_time()
-        self.mav.wait_heartbeat()
+        # this relies on flightmode being current: pymavlink updates it
+        # from every heartbeat it parses (including those read by
+        # get_sim_time above), and reboot_sitl parses a fresh heartbeat
+        # after discarding its backlog, so a pre-reboot mode can't match.
+        # Only wait for another heartbeat if we are not already there:
+        remaining = None
         while self.mav.flightmode != mode:
-            if (timeout is not None and
-                    self.get_sim_time() > tstart + timeout):
-                raise WaitModeTimeout()
-            self.mav.wait_heartbeat()
+            if timeout is not None:
+                remaining = timeout - (self.get_sim_time_cached() - tstart)
+                if remaining <= 0:
+                    raise WaitModeTimeout()
+            self.mav.wait_heartbeat(timeout=remaining)
         # self.progress("heartbeat mode %s Want: %s" % (
         # self.mav.flightmode, mode))
         self.progress("Got mode %s" % mode)
@@ -1173,39 +1481,42 @@ class AutoTest(ABC):
             return True
 
         tstart = self.get_sim_time()
-        # all of these must be set for arming to happen:
-        required_value = (mavutil.mavlink.EKF_ATTITUDE |
-                          mavutil.mavlink.ESTIMATOR_VELOCITY_HORIZ |
-                          mavutil.mavlink.ESTIMATOR_VELOCITY_VERT |
-                          mavutil.mavlink.ESTIMATOR_POS_HORIZ_REL |
-                          mavutil.mavlink.ESTIMATOR_PRED_POS_HORIZ_REL)
-        # none of these bits must be set for arming to happen:
-        error_bits = (mavutil.mavlink.ESTIMATOR_CONST_POS_MODE |
-                      mavutil.mavlink.ESTIMATOR_ACCEL_ERROR)
         if require_absolute:
-            required_value |= (mavutil.mavlink.ESTIMATOR_POS_HORIZ_ABS |
-                               mavutil.mavlink.ESTIMATOR_POS_VERT_ABS |
-                               mavutil.mavlink.ESTIMATOR_PRED_POS_HORIZ_ABS)
-            error_bits |= mavutil.mavlink.ESTIMATOR_GPS_GLITCH
+            required_value = EKF_REQUIRED_FLAGS_ABSOLUTE
+            error_bits = EKF_ERROR_FLAGS_ABSOLUTE
+        else:
+            required_value = EKF_REQUIRED_FLAGS
+            error_bits = EKF_ERROR_FLAGS
+        # happy means all required bits set and no error bits set:
+        mask = required_value | error_bits
 
         self.progress("Waiting for EKF value %u" % required_value)
         last_err_print_time = 0
         last_print_time = 0
-        while timeout is None or self.get_sim_time_cached() < tstart + timeout:
-            m = self.mav.recv_match(type='EKF_STATUS_REPORT', blocking=True)
+        remaining = None
+        while True:
+            now = self.get_sim_time_cached()
+            if timeout is not None:
+                remaining = timeout - (now - tstart)
+                if remaining <= 0:
+                    break
+            m = self.mav.recv_match(type='EKF_STATUS_REPORT',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
             current = m.flags
-            if self.get_sim_time_cached() - last_print_time > 1:
+            if now - last_print_time > 1:
                 self.progress("Wait EKF.flags: required:%u current:%u" %
                               (required_value, current))
-                last_print_time = self.get_sim_time_cached()
-            errors = current & error_bits
-            if errors and self.get_sim_time_cached() - last_err_print_time > 1:
-                self.progress("Wait EKF.flags: errors=%u" % errors)
-                last_err_print_time = self.get_sim_time_cached()
-                continue
-            if (current & required_value == required_value):
+                last_print_time = now
+            if current & mask == required_value:
                 self.progress("EKF Flags OK")
                 return True
+            errors = current & error_bits
+            if errors and now - last_err_print_time > 1:
+                self.progress("Wait EKF.flags: errors=%u" % errors)
+                last_err_print_time = now
         self.progress("Failed to get EKF.flags=%u" % required_value)
         raise AutoTestTimeoutException()
 
@@ -1213,23 +1524,38 @@ class AutoTest(ABC):
         """Wait a specific STATUS_TEXT."""
         self.progress("Waiting for text : %s" % text.lower())
         tstart = self.get_sim_time()
-        while self.get_sim_time() < tstart + timeout:
+        while True:
+            remaining = timeout - (self.get_sim_time_cached() - tstart)
+            if remaining <= 0:
+                break
             if the_function is not None:
                 the_function()
-            m = self.mav.recv_match(type='STATUSTEXT', blocking=True)
+            m = self.mav.recv_match(type='STATUSTEXT',
+                                    blocking=True,
+                                    timeout=remaining)
+            if m is None:
+                continue
             if text.lower() in m.text.lower():
                 self.progress("Received expected text : %s" % m.text.lower())
                 return True
         self.progress("Failed to received text : %s" % text.lower())
         raise AutoTestTimeoutException()
 
+    def use_native_mavlink(self):
+        '''returns true if pymavlink's C parser (mavnative) should be used
+        for the autotest connection.  Set AUTOTEST_MAVLINK_NATIVE=1 to
+        enable; pymavlink falls back to the Python parser if mavnative
+        was not built'''
+        return os.getenv("AUTOTEST_MAVLINK_NATIVE", "0") != "0"
+
     def get_mavlink_connection_going(self):
         # get a mavlink connection going
         connection_string = self.autotest_connection_string_to_mavproxy()
         try:
             self.mav = mavutil.mavlink_connection(connection_string,
                                                   robust_parsing=True,
-                                                  source_component=250)
+                                                  source_component=250,
+                                                  use_native=self.use_native_mavlink())
         except Exception as msg:
             self.progress("Failed to start mavlink connection on %s: %s" %
                           (connection_string, msg,))
@@ -1253,7 +1579,6 @@ class AutoTest(ABC):
 
     def check_test_syntax(self, test_file):
         """Check mistake on autotest function syntax."""
-        import re
         self.start_test("Check for syntax mistake in autotest lambda")
         if not os.path.isfile(test_file):
             self.progress("File %s does not exist" % test_file)
@@ -1261,7 +1586,7 @@ class AutoTest(ABC):
         try:
             with open(test_file) as f:
                 # check for lambda: test_function without paranthesis
-                faulty_strings = re.findall(r"lambda\s*:\s*\w+.\w+\s*\)", f.read())
+                faulty_strings = RE_LAMBDA_WITHOUT_CALL.findall(f.read())
                 if faulty_strings:
                     self.progress("Syntax error in autotest lamda at : ")
                     print(faulty_strings)
@@ -1309,12 +1634,7 @@ class AutoTest(ABC):
             # if not self.autodisarm_motors():
             #     raise NotAchievedException()
             # Disable auto disarm for next test
-        if self.mav.mav_type in [mavutil.mavlink.MAV_TYPE_QUADROTOR,
-                                 mavutil.mavlink.MAV_TYPE_HELICOPTER,
-                                 mavutil.mavlink.MAV_TYPE_HEXAROTOR,
-                                 mavutil.mavlink.MAV_TYPE_OCTOROTOR,
-                                 mavutil.mavlink.MAV_TYPE_COAXIAL,
-                                 mavutil.mavlink.MAV_TYPE_TRICOPTER]:
+        if self.mav.mav_type in COPTER_TYPES:
             self.set_parameter("DISARM_DELAY", 0)
         if self.mav.mav_type == mavutil.mavlink.MAV_TYPE_FIXED_WING:
             self.set_parameter("LAND_DISARMDELAY", 0)
@@ -1328,12 +1648,7 @@ class AutoTest(ABC):
         if not self.disarm_motors_with_switch(arming_switch):
             raise NotAchievedException()
         self.set_rc(arming_switch, 1000)
-        if self.mav.mav_type in [mavutil.mavlink.MAV_TYPE_QUADROTOR,
-                                 mavutil.mavlink.MAV_TYPE_HELICOPTER,
-                                 mavutil.mavlink.MAV_TYPE_HEXAROTOR,
-                                 mavutil.mavlink.MAV_TYPE_OCTOROTOR,
-                                 mavutil.mavlink.MAV_TYPE_COAXIAL,
-                                 mavutil.mavlink.MAV_TYPE_TRICOPTER]:
+        if self.mav.mav_type in COPTER_TYPES:
             self.start_test("Test arming failure with throttle too high")
             self.set_rc(3, 1800)
             try:
@@ -1373,12 +1688,7 @@ class AutoTest(ABC):
         self.disarm_vehicle()
         self.mav.wait_heartbeat()
         self.set_parameter("ARMING_RUDDER", 2)
-        if self.mav.mav_type in [mavutil.mavlink.MAV_TYPE_QUADROTOR,
-                                 mavutil.mavlink.MAV_TYPE_HELICOPTER,
-                                 mavutil.mavlink.MAV_TYPE_HEXAROTOR,
-                                 mavutil.mavlink.MAV_TYPE_OCTOROTOR,
-                                 mavutil.mavlink.MAV_TYPE_COAXIAL,
-                                 mavutil.mavlink.MAV_TYPE_TRICOPTER]:
+        if self.mav.mav_type in COPTER_TYPES:
             self.start_test("Test arming failure with interlock enabled")
             self.set_rc(interlock_channel, 2000)
             if self.arm_motors_with_rc_input():
@@ -1416,6 +1726,20 @@ class AutoTest(ABC):
         self.context_pop()
         # TODO : add failure test : arming check, wrong mode; Test arming magic; Same for disarm
 
+    def send_gripper_command(self, action):
+        """Send MAV_CMD_DO_GRIPPER for gripper 1."""
+        self.mav.mav.command_long_send(1,
+                                       1,
+                                       mavutil.mavlink.MAV_CMD_DO_GRIPPER,
+                                       0,
+                                       1,
+                                       action,
+                                       0,
+                                       0,
+                                       0,
+                                       0,
+                                       0)
+
     def test_gripper(self):
         self.context_push()
         self.set_parameter("GRIP_ENABLE", 1)
@@ -1448,60 +1772,20 @@ class AutoTest(ABC):
         self.progress("Test gripper with Mavlink cmd")
         self.progress("Releasing load")
         self.wait_text("Gripper load releas",
-                       the_function=lambda: self.mav.mav.command_long_send(1,
-                                                                           1,
-                                                                           mavutil.mavlink.MAV_CMD_DO_GRIPPER,
-                                                                           0,
-                                                                           1,
-                                                                           mavutil.mavlink.GRIPPER_ACTION_RELEASE,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           ))
+                       the_function=partial(self.send_gripper_command,
+                                            mavutil.mavlink.GRIPPER_ACTION_RELEASE))
         self.progress("Grabbing load")
         self.wait_text("Gripper load grabb",
-                       the_function=lambda: self.mav.mav.command_long_send(1,
-                                                                           1,
-                                                                           mavutil.mavlink.MAV_CMD_DO_GRIPPER,
-                                                                           0,
-                                                                           1,
-                                                                           mavutil.mavlink.GRIPPER_ACTION_GRAB,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           ))
+                       the_function=partial(self.send_gripper_command,
+                                            mavutil.mavlink.GRIPPER_ACTION_GRAB))
         self.progress("Releasing load")
         self.wait_text("Gripper load releas",
-                       the_function=lambda: self.mav.mav.command_long_send(1,
-                                                                           1,
-                                                                           mavutil.mavlink.MAV_CMD_DO_GRIPPER,
-                                                                           0,
-                                                                           1,
-                                                                           mavutil.mavlink.GRIPPER_ACTION_RELEASE,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           ))
+                       the_function=partial(self.send_gripper_command,
+                                            mavutil.mavlink.GRIPPER_ACTION_RELEASE))
         self.progress("Grabbing load")
         self.wait_text("Gripper load grabb",
-                       the_function=lambda: self.mav.mav.command_long_send(1,
-                                                                           1,
-                                                                           mavutil.mavlink.MAV_CMD_DO_GRIPPER,
-                                                                           0,
-                                                                           1,
-                                                                           mavutil.mavlink.GRIPPER_ACTION_GRAB,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           0,
-                                                                           ))
+                       the_function=partial(self.send_gripper_command,
+                                            mavutil.mavlink.GRIPPER_ACTION_GRAB))
         self.context_pop()
         self.reboot_sitl()
     #     # TEST MISSION FILE